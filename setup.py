@@ -54,6 +54,8 @@ setup(
     url='https://github.com/easydevmixin/django_ssh_storage',
     packages=[
         'ssh_storage',
+        'ssh_storage.management',
+        'ssh_storage.management.commands',
     ],
     include_package_data=True,
     install_requires=[],
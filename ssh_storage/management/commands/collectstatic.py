@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# collectstatic uploading files in parallel
+#
+# Django's collectstatic saves the files one by one, so with a remote storage
+# most of the time is spent waiting for the network. When the static files
+# storage provides save_many() (like SSHStorage does) the files are queued and
+# uploaded in batches over several connections.
+
+from django.contrib.staticfiles.management.commands import collectstatic
+
+
+# Number of files queued before they are uploaded
+BATCH_SIZE = 100
+
+
+class Command(collectstatic.Command):
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--max-workers', type=int, default=10, dest='max_workers',
+            help="Number of files uploaded at the same time when the storage supports it (default 10)."
+        )
+
+    def set_options(self, **options):
+        super(Command, self).set_options(**options)
+        self.max_workers = options['max_workers']
+
+    def _can_batch(self):
+        # Post-processing reads the copied files back from the storage, so
+        # they can't still be waiting in the queue when it runs
+        if self.dry_run or not hasattr(self.storage, 'save_many'):
+            return False
+        return not (self.post_process and hasattr(self.storage, 'post_process'))
+
+    def collect(self):
+        self._batching = self._can_batch()
+        self._pending = []
+        try:
+            collected = super(Command, self).collect()
+            self._flush()
+        finally:
+            # Don't keep the upload threads, and their SFTP sessions, once
+            # the files are collected
+            if self._batching and hasattr(self.storage, 'shutdown'):
+                self.storage.shutdown()
+        return collected
+
+    def delete_file(self, path, prefixed_path, source_storage):
+        # Compare checksums before Django removes the target, so unchanged
+        # files are neither deleted nor uploaded again. Only done when the
+        # storage asks for it and there is a target to compare with.
+        if getattr(self.storage, 'checksum_skip', False) and self.storage.exists(prefixed_path):
+            with source_storage.open(path) as source_file:
+                unchanged = self.storage.is_unchanged(prefixed_path, source_file)
+            if unchanged:
+                if prefixed_path not in self.unmodified_files:
+                    self.unmodified_files.append(prefixed_path)
+                self.log("Skipping '%s' (not modified)" % path)
+                return False
+        return super(Command, self).delete_file(path, prefixed_path, source_storage)
+
+    def copy_file(self, path, prefixed_path, source_storage):
+        if not self._batching:
+            return super(Command, self).copy_file(path, prefixed_path, source_storage)
+
+        if prefixed_path in self.copied_files:
+            return self.log("Skipping '%s' (already copied earlier)" % path)
+        # Still one file at a time: the checks and the removal of the old
+        # file cost a few round-trips per file before it's queued
+        if not self.delete_file(path, prefixed_path, source_storage):
+            return
+        self.log("Copying '%s'" % source_storage.path(path), level=2)
+        self._pending.append((path, prefixed_path, source_storage))
+        self.copied_files.append(prefixed_path)
+        if len(self._pending) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        source_files = [source_storage.open(path) for path, _, source_storage in pending]
+        try:
+            self.storage.save_many(
+                [(prefixed_path, source_file)
+                 for (_, prefixed_path, _), source_file in zip(pending, source_files)],
+                max_workers=self.max_workers
+            )
+        finally:
+            for source_file in source_files:
+                source_file.close()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Process-wide pool of authenticated SSH connections
+#
+# Every storage used to open its own TCP connection and go through the whole
+# key exchange and authentication. Connections are now kept here, keyed by
+# the credentials used to open them, and shared by all the storages pointing
+# to the same server. Each thread sticks to one connection, where it gets its
+# own SFTP session (see SSHClientManager.sftp). A connection serves up to
+# SESSIONS_PER_CONNECTION threads; more threads make the pool open another one.
+
+import logging
+import threading
+
+from collections import defaultdict
+
+from .sshclientmanager import SSHClientManager
+
+
+logger = logging.getLogger('ssh-storage')
+
+_lock = threading.Lock()
+_shared = defaultdict(list)
+_local = threading.local()
+
+
+def _key(config):
+    return (
+        config['hostname'],
+        config['username'],
+        config['port'],
+        config['rsa_key'],
+        config['password'],
+        config['buffer_size'],
+    )
+
+
+def _assigned():
+    # Connection serving the current thread, by key
+    try:
+        return _local.managers
+    except AttributeError:
+        _local.managers = {}
+        return _local.managers
+
+
+def acquire(config):
+    """Return the connection the current thread uses for the given config.
+
+    The connection is shared with the other threads and storages using the
+    same server. Connections that died are replaced. Returns None if the
+    connection or login fails.
+    """
+    key = _key(config)
+    assigned = _assigned()
+    manager = assigned.get(key)
+    if manager is not None and manager.is_active():
+        return manager
+
+    with _lock:
+        managers = _shared[key]
+        for dead in [m for m in managers if not m.is_active()]:
+            managers.remove(dead)
+            dead.close_connection()
+        manager = None
+        for candidate in managers:
+            if candidate.claim():
+                manager = candidate
+                break
+
+    if manager is None:
+        # Storages give full remote paths, so the connection has no base path
+        manager = SSHClientManager(
+            hostname=config['hostname'],
+            username=config['username'],
+            basepath='',
+            password=config['password'],
+            rsa_key=config['rsa_key'],
+            port=config['port'],
+            buffer_size=config['buffer_size']
+        )
+        if not manager.setup():
+            return None
+        manager.pool_key = key
+        manager.claim()
+        with _lock:
+            _shared[key].append(manager)
+
+    assigned[key] = manager
+    return manager
+
+
+def release(config):
+    """Stop using the connection the current thread has for the given config.
+
+    Its SFTP session is closed, leaving room for another thread. The
+    connection itself stays open.
+    """
+    manager = _assigned().pop(_key(config), None)
+    if manager is not None:
+        manager.close_sftp()
+
+
+def clear():
+    """Close every connection in the pool."""
+    with _lock:
+        managers = [manager for group in _shared.values() for manager in group]
+        _shared.clear()
+
+    for manager in managers:
+        manager.close_connection()
@@ -1,21 +1,51 @@
 # -*- coding: utf-8 -*-
 # Part of the code inspired from https://gist.github.com/JordanReiter/3667759
 
+import errno
 import logging
 import os
+import posixpath
+import shutil
+import socket
+import threading
 
 import paramiko
 
+from six.moves import shlex_quote
+
 
 logger = logging.getLogger('ssh-storage')
 
+# Default size of the chunks read from the local file while uploading
+BUFFER_SIZE = 1024 * 1024
+
+# Receive window of the SFTP channel: how much the server may send before
+# waiting for us to acknowledge it. It bounds download speed on fast, distant
+# links (see PREFETCH_SIZE in storage.py); uploads are bound by the window the
+# server advertises instead, which can't be set from here.
+WINDOW_SIZE = 4 * 1024 * 1024
+
+# Seconds to wait for the TCP connection, the SSH banner and authentication
+CONNECT_TIMEOUT = 10
+
+# Seconds between keepalive packets, so NAT boxes and firewalls don't drop
+# idle connections kept around by the pool
+KEEPALIVE_INTERVAL = 30
+
+# SSH servers limit the channels open on one connection (MaxSessions, 10 on
+# OpenSSH). A thread holds an SFTP session and, while creating directories or
+# computing checksums, an exec channel too, so the pool doesn't put more than
+# this many threads on one connection.
+SESSIONS_PER_CONNECTION = 5
+
 
 class SSHClientManagerException(Exception):
     pass
 
 
 class SSHClientManager:
-    def __init__(self, hostname, username=None, password=None, port=22, rsa_key=None, basepath=None, *args, **kwargs):
+    def __init__(self, hostname, username=None, password=None, port=22, rsa_key=None, basepath=None,
+                 buffer_size=BUFFER_SIZE, *args, **kwargs):
         self.hostname = hostname
         self.username = username
         self.password = password
@@ -23,8 +53,16 @@ class SSHClientManager:
         self.rsa_key = rsa_key
         self.basepath = basepath
         self.currentpath = basepath
+        self.buffer_size = buffer_size
         self._ssh = None
-        self._sftp = None
+        # SFTP sessions are opened on demand, one per thread, over the same
+        # SSH connection so threads never share an SFTPClient
+        self._local = threading.local()
+        self._sftp_clients = {}
+        self._sftp_lock = threading.Lock()
+        self.pool_key = None
+        # Directories known to exist on the remote server
+        self._mkdir_cache = set()
         super(SSHClientManager, self).__init__(*args, **kwargs)
 
     def check(self):
@@ -39,6 +77,9 @@ class SSHClientManager:
         self.set_missing_host_key_policy()
         ssh_kwargs = {}
         ssh_kwargs['port'] = self.port
+        ssh_kwargs['timeout'] = CONNECT_TIMEOUT
+        ssh_kwargs['banner_timeout'] = CONNECT_TIMEOUT
+        ssh_kwargs['auth_timeout'] = CONNECT_TIMEOUT
         if self.username:
             ssh_kwargs['username'] = self.username
         if self.password:
@@ -50,19 +91,70 @@ class SSHClientManager:
     def connect(self, **kwargs):
         try:
             self._ssh.connect(self.hostname, **kwargs)
-            self._sftp = self._ssh.open_sftp()
+            self._ssh.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
             logger.debug("OK. Connection established!")
             return True
-        except paramiko.SSHException:
+        except (paramiko.SSHException, socket.error):
             logger.debug("Connection Failed")
             return False
 
+    def is_active(self):
+        if self._ssh is None:
+            return False
+        transport = self._ssh.get_transport()
+        return transport is not None and transport.is_active()
+
     @property
     def sftp(self):
-        """Lazy SFTP connection"""
-        if not hasattr(self, '_sftp'):
-            self.setup()
-        return self._sftp
+        """Lazy SFTP connection, one per thread"""
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = self._open_sftp()
+        return sftp
+
+    def _close_dead_sessions(self):
+        # Must be called holding _sftp_lock
+        for thread in [t for t in self._sftp_clients if not t.is_alive()]:
+            sftp = self._sftp_clients.pop(thread)
+            if sftp is not None:
+                sftp.close()
+
+    def claim(self):
+        """Reserve an SFTP session on this connection for the current thread.
+
+        Returns False if the connection already serves
+        SESSIONS_PER_CONNECTION threads.
+        """
+        current = threading.current_thread()
+        with self._sftp_lock:
+            self._close_dead_sessions()
+            if current in self._sftp_clients:
+                return True
+            if len(self._sftp_clients) >= SESSIONS_PER_CONNECTION:
+                return False
+            self._sftp_clients[current] = None
+            return True
+
+    def _open_sftp(self):
+        if self._ssh is None and not self.setup():
+            raise SSHClientManagerException("Connection to {} failed".format(self.hostname))
+        with self._sftp_lock:
+            # Don't keep the sessions of threads that are gone
+            self._close_dead_sessions()
+        # Only a new channel on the existing transport, no new handshake
+        sftp = paramiko.SFTPClient.from_transport(self._ssh.get_transport(), window_size=WINDOW_SIZE)
+        with self._sftp_lock:
+            self._sftp_clients[threading.current_thread()] = sftp
+        self._local.sftp = sftp
+        return sftp
+
+    def close_sftp(self):
+        # Close the SFTP session of the current thread, if it has one
+        self._local.sftp = None
+        with self._sftp_lock:
+            sftp = self._sftp_clients.pop(threading.current_thread(), None)
+        if sftp is not None:
+            sftp.close()
 
     def set_missing_host_key_policy(self, policy=paramiko.AutoAddPolicy()):
         self._ssh.set_missing_host_key_policy(policy)
@@ -72,26 +164,54 @@ class SSHClientManager:
         return stdin, stdout, stderr
 
     def mkdir(self, path, recursive=True):
+        if path in self._mkdir_cache:
+            return path
+
         try:
-            self._sftp.mkdir(path)
+            self.sftp.mkdir(path)
         except IOError:
             if recursive:
-                pathdirs = path.split(os.path.sep)
-                for pp in range(1, len(pathdirs)):
-                    currentpath = os.path.join('/', *pathdirs[:pp + 1])
-                    try:
-                        self._sftp.lstat(currentpath)
-                    except IOError:
-                        self._sftp.mkdir(currentpath)
+                if not self._mkdir_remote(path):
+                    self._mkdir_walk(path)
             else:
                 raise
+        self._mkdir_cache.add(path)
         return path
 
-    def upload(self, sourcefile, path=None, destname=None, overwrite=True):
-        is_file = False
-        if hasattr(sourcefile, 'file'):
-            is_file = True
+    def _mkdir_remote(self, path):
+        # One round-trip whatever the depth, as long as the server lets us
+        # run commands
+        try:
+            _, stdout, _ = self.execute_command('mkdir -p -- {}'.format(shlex_quote(path)))
+            return stdout.channel.recv_exit_status() == 0
+        except paramiko.SSHException:
+            return False
+
+    def checksum(self, path):
+        # SHA-256 of a remote file computed on the server, or None if the file
+        # is missing or commands can't be run
+        try:
+            _, stdout, _ = self.execute_command('sha256sum -- {}'.format(shlex_quote(path)))
+            output = stdout.read()
+            if stdout.channel.recv_exit_status() != 0:
+                return None
+        except paramiko.SSHException:
+            return None
+        digest = output[:64].decode('ascii', 'replace')
+        if len(digest) != 64:
+            return None
+        return digest.lower()
+
+    def _mkdir_walk(self, path):
+        pathdirs = path.split('/')
+        for pp in range(1, len(pathdirs)):
+            currentpath = posixpath.join('/', *pathdirs[:pp + 1])
+            try:
+                self.sftp.lstat(currentpath)
+            except IOError:
+                self.sftp.mkdir(currentpath)
 
+    def upload(self, sourcefile, path=None, destname=None, overwrite=True):
         try:
             filename = sourcefile.name
         except AttributeError:
@@ -103,59 +223,83 @@ class SSHClientManager:
         if not path:
             path = self.currentpath
         else:
-            path = os.path.join(self.basepath, path)
+            path = posixpath.join(self.basepath, path)
         self.mkdir(path)
 
-        destpath = os.path.join(path, destname)
-        filename_prefix, filename_ext = os.path.splitext(destpath)
+        if not overwrite:
+            destname = self._free_name(path, destname)
+        destpath = posixpath.join(path, destname)
 
-        counter = 0
-        while True:
-            try:
-                self._sftp.lstat(destpath)
-                if overwrite:
-                    logger.debug("Filename found. Overwriting")
-                    break
-                counter += 1
-                destpath = "{}_{}{}".format(
-                    filename_prefix,
-                    counter,
-                    filename_ext
-                )
-                logger.debug("Filename found. Will try {}".format(destpath))
-            except:
-                break
         try:
-            logger.debug("Uploading {} to {}".format(filename, destpath))
-            if is_file:
-                self._sftp.putfo(sourcefile, destpath)
-            else:
-                self._sftp.put(filename, destpath)
+            logger.debug("Uploading %s to %s", filename, destpath)
+            try:
+                self._write(sourcefile, destpath)
+            except IOError as ioe:
+                # The directory may have been removed since it was cached.
+                # Opening the remote file is what fails then, so nothing has
+                # been read from the source yet.
+                if ioe.errno != errno.ENOENT or path not in self._mkdir_cache:
+                    raise
+                self._mkdir_cache.discard(path)
+                self.mkdir(path)
+                self._write(sourcefile, destpath)
             return True
         except IOError as ioe:
-            logger.error("There were problems uploading {} to {}.\n{}".format(
-                filename,
-                destpath,
-                ioe
-            ))
+            logger.error("There were problems uploading %s to %s.\n%s", filename, destpath, ioe)
 
         return False
 
+    def _write(self, source, destpath):
+        if hasattr(source, 'read'):
+            self._write_pipelined(source, destpath)
+        else:
+            with open(source, 'rb') as localfile:
+                self._write_pipelined(localfile, destpath)
+
+    def _free_name(self, path, destname):
+        # List the directory once and look for a free name locally, instead
+        # of probing name_1, name_2... with one lstat round-trip each
+        try:
+            existing = set(self.sftp.listdir(path))
+        except IOError:
+            return destname
+
+        filename_prefix, filename_ext = posixpath.splitext(destname)
+        counter = 0
+        while destname in existing:
+            counter += 1
+            destname = "{}_{}{}".format(
+                filename_prefix,
+                counter,
+                filename_ext
+            )
+            logger.debug("Filename found. Will try %s", destname)
+        return destname
+
+    def _write_pipelined(self, sourcefile, destpath):
+        # With pipelining on, paramiko sends every SSH_FXP_WRITE without
+        # waiting for its status, and only collects the ACKs when the file
+        # is closed. Reading the source in big chunks keeps the outgoing
+        # queue full so the transfer isn't bound by the round-trip time.
+        with self.sftp.open(destpath, 'wb') as remotefile:
+            remotefile.set_pipelined(True)
+            shutil.copyfileobj(sourcefile, remotefile, self.buffer_size)
+
     def remove(self, filename, path=None):
-        _, filename = os.path.split(filename)
+        _, filename = posixpath.split(filename)
 
         if not path:
             path = self.currentpath
         else:
-            path = os.path.join(self.basepath, path)
+            path = posixpath.join(self.basepath, path)
 
-        destpath = os.path.join(path, filename)
-        logger.debug("Removing file: {}".format(destpath))
+        destpath = posixpath.join(path, filename)
+        logger.debug("Removing file: %s", destpath)
         try:
-            self._sftp.remove(destpath)
+            self.sftp.remove(destpath)
             return True
         except IOError:
-            logger.error("The path '{}' doesn't exist.".format(destpath))
+            logger.error("The path '%s' doesn't exist.", destpath)
 
         return False
 
@@ -168,10 +312,15 @@ class SSHClientManager:
             self.rsa_key = None
             self.basepath = None
             self.currentpath = None
-            self._sftp.close()
+            with self._sftp_lock:
+                sftp_clients, self._sftp_clients = self._sftp_clients, {}
+            self._local = threading.local()
+            for sftp in sftp_clients.values():
+                if sftp is not None:
+                    sftp.close()
             self._ssh.close()
-            self._sftp = None
             self._ssh = None
+            self._mkdir_cache.clear()
             return True
         except:
             return False
@@ -22,40 +22,134 @@
 #                          as HOSTNAME
 # - STATIC_PROXY_PORT: Port number of the proxy serving static assets. If empty or not provided its value
 #                      will 80
+# - CHECKSUM_SKIP: If True, collectstatic doesn't upload again files whose SHA-256 matches the one already on the
+#                  server. Default is False
+# - CHECKSUM_CACHE: Alias of the Django cache keeping the remote checksums. Default is 'default'
+# - BUFFER_SIZE: Size in bytes of the chunks read from the files being uploaded. Default is 1 MB
 
+import hashlib
 import logging
 import os
 import posixpath
 import stat
+import threading
+import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.files.base import File
 from django.core.files.storage import Storage
-from django.core.exceptions import ImproperlyConfigured
-from six import BytesIO
+from django.core.exceptions import ImproperlyConfigured, SuspiciousFileOperation
+from six import BytesIO, string_types
 
-from .sshclientmanager import SSHClientManager
+from . import pool
+from .sshclientmanager import BUFFER_SIZE
 
 
 logger = logging.getLogger('ssh-storage')
 
+# Decoded configurations by location, so storages built from the same
+# settings don't validate them again
+_decoded_locations = {}
+
+# Number of remote file attributes kept by each storage, and for how many
+# seconds. Other processes may change the files, so keep it short.
+STAT_CACHE_SIZE = 1024
+STAT_CACHE_TIMEOUT = 5
+
+# Bytes requested ahead of the current position when reading a remote file.
+# As much as the SFTP receive window (WINDOW_SIZE) lets the server send at
+# once, without holding large files in memory.
+PREFETCH_SIZE = 4 * 1024 * 1024
+
 
 class SSHStorageException(Exception):
     pass
 
 
+class StatCache(object):
+    """Small LRU of SFTPAttributes by remote path, with expiry."""
+
+    def __init__(self, size=STAT_CACHE_SIZE, timeout=STAT_CACHE_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            expires, attr = self._items.pop(path)
+            if expires < time.time():
+                raise KeyError(path)
+            # Reinsert it as the most recently used
+            self._items[path] = (expires, attr)
+            return attr
+
+    def set(self, path, attr):
+        with self._lock:
+            self._items.pop(path, None)
+            self._items[path] = (time.time() + self.timeout, attr)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def forget(self, path):
+        with self._lock:
+            self._items.pop(path, None)
+
+    def forget_children(self, dirpath):
+        # dirpath must end with a slash
+        with self._lock:
+            for path in [p for p in self._items if p.startswith(dirpath) and '/' not in p[len(dirpath):]]:
+                del self._items[path]
+
+
+def _validate_name(name):
+    """Reject names that would escape the storage's base path.
+
+    The same checks Storage.save() makes through Django's
+    validate_file_name(name, allow_relative_path=True), which older Django
+    versions don't have.
+    """
+    if posixpath.basename(name) in ('', '.', '..'):
+        raise SuspiciousFileOperation("Could not derive file name from '{}'".format(name))
+    if posixpath.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise SuspiciousFileOperation("Detected path traversal attempt in '{}'".format(name))
+    return name
+
+
 class SSHStorage(Storage):
     def __init__(self, location=settings.SSH_STORAGE_LOCATION, *args, **kwargs):
-        logger.debug("__init__")
         super(SSHStorage, self).__init__(*args, **kwargs)
-        self._config = self._decode_location(location)
-        self._ssh_client_manager = None
+        self._config = self._get_config(location)
         self._pathmod = posixpath
+        # SFTPAttributes by remote path, to save a round-trip per stat call
+        self._stat_cache = StatCache()
+        # Worker threads of save_many, kept so their SFTP sessions are reused
+        self._executor = None
+        self._executor_workers = None
+        self._executor_lock = threading.Lock()
+        self._update_prefixes()
+
+    def _get_config(self, location):
+        try:
+            key = frozenset(location.items())
+        except TypeError:
+            # Unhashable settings values, no way to cache them
+            return self._decode_location(location)
+
+        try:
+            config = _decoded_locations[key]
+        except KeyError:
+            config = self._decode_location(location)
+            _decoded_locations[key] = config
+        # Subclasses alter their own copy through _add_to_basepath
+        return dict(config)
 
     def _decode_location(self, location):
-        logger.debug("_decode_location")
         # Mandatory attributes
         if location.get('HOSTNAME', '') == '':
             logger.fatal('A hostname must be provided.')
@@ -135,90 +229,109 @@ class SSHStorage(Storage):
             except ValueError:
                 config['static_proxy_port'] = '80'
 
+        checksum_skip = location.get('CHECKSUM_SKIP', False)
+        if isinstance(checksum_skip, string_types):
+            checksum_skip = checksum_skip.lower() in ('1', 'true', 'yes', 'on')
+        config['checksum_skip'] = bool(checksum_skip)
+        config['checksum_cache'] = location.get('CHECKSUM_CACHE', '') or 'default'
+
+        try:
+            buffer_size = int(location.get('BUFFER_SIZE', ''))
+        except ValueError:
+            buffer_size = 0
+        config['buffer_size'] = buffer_size if buffer_size > 0 else BUFFER_SIZE
+
         return config
 
     def _add_to_basepath(self, location):
-        logger.debug("_add_to_basepath")
         self._config['location'] = location
         _path = self._config['basepath']
-        _path = os.path.join(_path, location)
+        _path = self._join(_path, location)
         self._config['basepath'] = _path
+        self._update_prefixes()
 
-    def _start_connection(self):
-        logger.debug("_start_connection")
-        # Check if connection is still alive and if not, drop it.
-        if self._ssh_client_manager is not None:
-            try:
-                self._ssh_client_manager.check()
-            except:
-                try:
-                    self._ssh_client_manager.close_connection()
-                except:
-                    pass
-                self._ssh_client_manager = None
-
-        # Real reconnect
-        if self._ssh_client_manager is None:
-            self._ssh_client_manager = SSHClientManager(
-                hostname=self._config['hostname'],
-                username=self._config['username'],
-                basepath=self._config['basepath'],
-                password=self._config['password'],
-                rsa_key=self._config['rsa_key'],
-                port=self._config['port']
-            )
-            if not self._ssh_client_manager.setup():
-                logger.error("Connection or login error using data {}".format(
-                        repr(self._config)
-                    )
-                )
-                raise SSHStorageException(
-                    "Connection or login error using data {}".format(
-                        repr(self._config)
-                    )
+    def _update_prefixes(self):
+        # _remote_path() and url() run once per file, so everything that
+        # doesn't depend on the name is computed here, ending with a slash
+        self._basepath = self._join(self._config['basepath'], '')
+        hostname_aux = self._config['static_proxy_hostname']
+        if self._config['static_proxy_port'] != '80':
+            hostname_aux = "{}:{}".format(hostname_aux, self._config['static_proxy_port'])
+        self._url_prefix = self._join(
+            self._config['static_proxy_protocol'],
+            hostname_aux,
+            self._config.get('location', ''),
+            ''
+        )
+
+    def _acquire(self):
+        manager = pool.acquire(self._config)
+        if manager is None:
+            logger.error("Connection or login error using data %r", self._config)
+            raise SSHStorageException(
+                "Connection or login error using data {}".format(
+                    repr(self._config)
                 )
+            )
+        return manager
 
     @property
     def ssh_client_manager(self):
-        logger.debug("ssh_client_manager")
-        # Lazy initializer
-        if self._ssh_client_manager is None:
-            self._start_connection()
-        return self._ssh_client_manager
+        # The connection is shared with the other storages using the same
+        # server, and replaced by the pool if it was dropped
+        return self._acquire()
 
     def _join(self, *args):
-        logger.debug("_join")
         # Use the path module for the remote host type to join a path together
         return self._pathmod.join(*args)
 
     def _remote_path(self, name):
-        logger.debug("_remote_path")
-        return self._join(self._config['basepath'], name)
+        # Like url(), a leading slash doesn't make the name absolute
+        return self._basepath + name.lstrip('/')
 
     def _isdir_attr(self, item):
-        logger.debug("_isdir_attr")
         # Return whether an item in sftp.listdir_attr results is a directory
         if item.st_mode is not None:
             return stat.S_IFMT(item.st_mode) == stat.S_IFDIR
         else:
             return False
 
+    def _stat(self, name):
+        remote_path = self._remote_path(name)
+        try:
+            return self._stat_cache.get(remote_path)
+        except KeyError:
+            pass
+        attr = self.ssh_client_manager.sftp.stat(remote_path)
+        self._stat_cache.set(remote_path, attr)
+        return attr
+
+    def _forget_stat(self, name):
+        self._stat_cache.forget(self._remote_path(name))
+
     def exists(self, name):
-        logger.debug("exists")
         # Try to retrieve file info.  Return true on success, false on failure.
-        remote_path = self._remote_path(name)
         try:
-            self.ssh_client_manager.sftp.stat(remote_path)
+            self._stat(name)
             return True
         except IOError:
             return False
 
     def listdir(self, path):
-        logger.debug("listdir")
         remote_path = self._remote_path(path)
-        logger.debug("REMOTE PATH: {}".format(remote_path))
+        logger.debug("REMOTE PATH: %s", remote_path)
         dirs, files = [], []
-        for item in self.ssh_client_manager.sftp.listdir_attr(remote_path):
+        items = self.ssh_client_manager.sftp.listdir_attr(remote_path)
+        # The listing is the current state of the directory: forget whatever
+        # was cached for its entries, then keep the attributes that came with
+        # it so the usual exists()/size() calls that follow are free.
+        # Symbolic links are left out: listdir_attr describes the link itself,
+        # while _stat() follows it.
+        prefix = self._join(remote_path, '')
+        self._stat_cache.forget_children(prefix)
+        for item in items:
+            if item.st_mode is not None and not stat.S_ISLNK(item.st_mode):
+                self._stat_cache.set(prefix + item.filename, item)
             if self._isdir_attr(item):
                 dirs.append(item.filename)
             else:
@@ -226,89 +339,158 @@ class SSHStorage(Storage):
         return dirs, files
 
     def disconnect(self):
-        logger.debug("disconnect")
-        if self._ssh_client_manager:
-            self._ssh_client_manager.close_connection()
-            self._ssh_client_manager = None
+        pool.release(self._config)
+
+    def _checksum_key(self, remote_path):
+        key = '{}:{}'.format(self._config['hostname'], remote_path)
+        return 'ssh-storage:sha256:{}'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    @property
+    def _checksum_cache(self):
+        return caches[self._config['checksum_cache']]
+
+    def _local_checksum(self, content):
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        content.seek(0)
+        return sha256.hexdigest()
+
+    def _remote_checksum(self, remote_path):
+        key = self._checksum_key(remote_path)
+        checksum = self._checksum_cache.get(key)
+        if checksum is None:
+            checksum = self.ssh_client_manager.checksum(remote_path)
+            if checksum is not None:
+                self._checksum_cache.set(key, checksum, None)
+        return checksum
+
+    @property
+    def checksum_skip(self):
+        """Whether CHECKSUM_SKIP is set, so is_unchanged() compares files."""
+        return self._config['checksum_skip']
+
+    def is_unchanged(self, name, content):
+        """Return whether the file stored as name has the same SHA-256 as content.
+
+        Always False unless CHECKSUM_SKIP is set. The remote checksum is
+        computed on the server and then kept in the CHECKSUM_CACHE cache.
+        """
+        if not self._config['checksum_skip']:
+            return False
+        return self._local_checksum(content) == self._remote_checksum(self._remote_path(name))
 
     def _put_file(self, name, content):
-        logger.debug("_put_file")
-        # Connection must be open!
-        path, destname = os.path.split(name)
-        logger.debug("PATH: {}, DESTNAME: {}".format(
-            path,
-            destname
-        ))
-        result = self._ssh_client_manager.upload(
+        # The connection may be shared by storages with other base paths, so
+        # it's given the full remote directory
+        path, destname = self._pathmod.split(self._remote_path(name))
+        logger.debug("PATH: %s, DESTNAME: %s", path, destname)
+
+        result = self.ssh_client_manager.upload(
             sourcefile=content,
             destname=destname,
-            path=path if path != '' else None
+            path=path
         )
 
         if not result:
-            logger.error("Error writing file {}".format(name))
+            logger.error("Error writing file %s", name)
             raise SSHStorageException("Error writing file {}".format(name))
 
+        if self._config['checksum_skip']:
+            self._checksum_cache.set(
+                self._checksum_key(self._remote_path(name)),
+                self._local_checksum(content),
+                None
+            )
+
     def _read(self, name):
-        logger.debug("_read")
         remote_path = self._remote_path(name)
+        # Unbuffered, so tell() is where the next request starts. Reads are
+        # prefetched by SSHStorageFile.read.
         return self.ssh_client_manager.sftp.open(remote_path, 'rb')
 
     def _open(self, name, mode='rb'):
-        logger.debug("_open")
         return SSHStorageFile(name, self, mode)
 
     def _save(self, name, content):
-        logger.debug("_save")
-        content.open()
-        self._start_connection()
+        # Closing the content is up to the caller
+        if getattr(content, 'closed', False):
+            content.open()
+        else:
+            content.seek(0)
         self._put_file(name, content)
-        content.close()
+        self._forget_stat(name)
         return name
 
+    def save_many(self, items, max_workers=10):
+        """Save several (name, content) pairs in parallel.
+
+        Each worker thread uploads through its own SFTP session. The threads,
+        and so their sessions, are kept for the next calls with the same
+        max_workers until shutdown() is called. Names are validated like
+        save() does, but used as given: existing files are overwritten.
+        Returns the list of saved names, in the same order as items. If some
+        saves fail, the first error is raised once all of them are done.
+        """
+        items = [
+            (_validate_name(name), content if hasattr(content, 'chunks') else File(content, name))
+            for name, content in items
+        ]
+        if not items:
+            return []
+
+        executor = self._get_executor(max_workers)
+        futures = [executor.submit(self._save, name, content) for name, content in items]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def _get_executor(self, max_workers):
+        with self._executor_lock:
+            if self._executor is None or self._executor_workers != max_workers:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._executor = ThreadPoolExecutor(max_workers=max_workers)
+                self._executor_workers = max_workers
+            return self._executor
+
+    def shutdown(self):
+        """Stop the worker threads of save_many, once their saves are done.
+
+        The SFTP sessions they used are closed the next time their connection
+        opens or hands out a session, or when it's closed.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+            self._executor_workers = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
     def delete(self, name):
-        logger.debug("delete")
         remote_path = self._remote_path(name)
+        self._forget_stat(name)
+        if self._config['checksum_skip']:
+            self._checksum_cache.delete(self._checksum_key(remote_path))
         self.ssh_client_manager.sftp.remove(remote_path)
 
     def size(self, name):
-        logger.debug("size")
-        remote_path = self._remote_path(name)
-        return self.ssh_client_manager.sftp.stat(remote_path).st_size
+        return self._stat(name).st_size
 
     def modified_time(self, name):
-        logger.debug("modified_time")
-        remote_path = self._remote_path(name)
-        utime = self.ssh_client_manager.sftp.stat(remote_path).st_mtime
+        utime = self._stat(name).st_mtime
         return datetime.fromtimestamp(utime)
 
     def accessed_time(self, name):
-        logger.debug("accessed_time")
-        remote_path = self._remote_path(name)
-        utime = self.ssh_client_manager.sftp.stat(remote_path).st_atime
+        utime = self._stat(name).st_atime
         return datetime.fromtimestamp(utime)
 
     def created_time(self, name):
-        logger.debug("created_time")
         pass
 
     def path(self, name):
-        logger.debug("path")
         pass
 
     def url(self, name):
-        logger.debug("url")
-        hostname_aux = self._config['static_proxy_hostname']
-        if self._config['static_proxy_port'] != '80':
-            hostname_aux = "{}:{}".format(hostname_aux, self._config['static_proxy_port'])
-        the_url = os.path.join(
-            self._config['static_proxy_protocol'],
-            hostname_aux,
-            self._config['location'],
-            name
-        ).replace('\\', '/')
-        logger.debug("URL: {}".format(the_url))
-        return the_url
+        return self._url_prefix + name.lstrip('/')
 
 
 class SSHStorageFile(File):
@@ -318,30 +500,52 @@ class SSHStorageFile(File):
         self._mode = mode
         self._is_dirty = False
         self.file = BytesIO()
+        self._remote_file = None
+        self._prefetched_to = 0
         self._size = None
 
     @property
     def size(self):
-        logger.debug("I am the size")
-        if not hasattr(self, '_size'):
+        if self._size is None:
             self._size = self._storage.size(self._name)
         return self._size
 
     def read(self, num_bytes=None):
-        logger.debug("I am the read")
-        self.file = self._storage._read(self._name)
-
-        return self.file.read(num_bytes)
+        if self._remote_file is None:
+            self._remote_file = self._storage._read(self._name)
+            self.file = self._remote_file
+
+        remote_file = self._remote_file
+        if num_bytes is None or num_bytes < 0:
+            num_bytes = self.size - remote_file.tell()
+        # Prefetch a window of at least PREFETCH_SIZE bytes from the current
+        # position, and the next one once it has been read, so paramiko keeps
+        # many requests in flight instead of waiting one round-trip per 32 KB
+        # without fetching what the caller never reads
+        data = []
+        while num_bytes > 0:
+            position = remote_file.tell()
+            if position >= self._prefetched_to:
+                end = min(self.size, position + max(num_bytes, PREFETCH_SIZE))
+                if end <= position:
+                    break
+                remote_file.prefetch(end)
+                self._prefetched_to = end
+            chunk = remote_file.read(min(num_bytes, self._prefetched_to - position))
+            if not chunk:
+                break
+            data.append(chunk)
+            num_bytes -= len(chunk)
+        return b''.join(data)
 
     def write(self, content):
-        logger.debug("I am the write")
         if 'w' not in self._mode:
             raise AttributeError("File was opened for read-only access.")
         self.file = BytesIO(content)
         self._is_dirty = True
 
     def close(self):
-        logger.debug("I am the close")
         if self._is_dirty:
-            self._storage._save(self._name, self.file.getvalue())
+            self.file.seek(0)
+            self._storage._save(self._name, File(self.file))
         self.file.close()
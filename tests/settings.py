@@ -23,6 +23,7 @@ INSTALLED_APPS = [
     "django.contrib.contenttypes",
     "django.contrib.sites",
     "ssh_storage",
+    "django.contrib.staticfiles",
 ]
 
 SITE_ID = 1
@@ -31,3 +32,12 @@ if django.VERSION >= (1, 10):
     MIDDLEWARE = ()
 else:
     MIDDLEWARE_CLASSES = ()
+
+SSH_STORAGE_LOCATION = {
+    "HOSTNAME": "ssh.example.com",
+    "USERNAME": "storage",
+    "PASSWORD": "secret",
+    "BASEPATH": "/srv/storage",
+}
+
+STATIC_URL = "/static/"
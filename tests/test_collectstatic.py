@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_collectstatic
+------------
+
+Tests for the `collectstatic` command of `ssh_storage`.
+"""
+
+import shutil
+import tempfile
+
+import mock
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.test import SimpleTestCase, override_settings
+
+from ssh_storage.management.commands.collectstatic import Command
+
+
+class RecordingStorage(Storage):
+    """In-memory storage recording what is saved."""
+
+    def __init__(self, files=()):
+        self.files = dict((name, b'') for name in files)
+        self.saved = []
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        del self.files[name]
+
+    def _save(self, name, content):
+        self.files[name] = content.read()
+        self.saved.append((name, self.files[name]))
+        return name
+
+
+
+class BatchStorage(RecordingStorage):
+    """RecordingStorage with save_many(), recording the batches."""
+
+    def __init__(self, files=()):
+        super(BatchStorage, self).__init__(files)
+        self.batches = []
+        self.shutdown = mock.Mock()
+
+    def save_many(self, items, max_workers=10):
+        self.batches.append([(name, content.read()) for name, content in items])
+        return [name for name, _ in items]
+
+
+class PostProcessingStorage(BatchStorage):
+
+    def post_process(self, paths, dry_run=False, **options):
+        return []
+
+class CommandTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source_dir)
+        self.source_storage = FileSystemStorage(location=self.source_dir)
+        for name in ('a.css', 'b.js'):
+            self.source_storage.save(name, ContentFile(name.encode()))
+
+    def command(self, storage, *args):
+        command = Command()
+        command.storage = storage
+        parser = command.create_parser('manage.py', 'collectstatic')
+        command.set_options(**vars(parser.parse_args(['--verbosity', '0'] + list(args))))
+        command._batching = command._can_batch()
+        command._pending = []
+        return command
+
+    def copy_all(self, command):
+        for name in ('a.css', 'b.js'):
+            command.copy_file(name, name, self.source_storage)
+        command._flush()
+
+
+class TestChecksumSkip(CommandTestCase):
+
+    def storage(self, checksum_skip, files=()):
+        storage = RecordingStorage(files)
+        storage.checksum_skip = checksum_skip
+        storage.is_unchanged = mock.Mock(side_effect=lambda name, content: name == 'a.css')
+        return storage
+
+    def test_disabled(self):
+        storage = self.storage(False, files=['a.css', 'b.js'])
+        self.copy_all(self.command(storage))
+        storage.is_unchanged.assert_not_called()
+        self.assertEqual(storage.saved, [('a.css', b'a.css'), ('b.js', b'b.js')])
+
+    def test_new_files_not_compared(self):
+        storage = self.storage(True)
+        self.copy_all(self.command(storage))
+        storage.is_unchanged.assert_not_called()
+        self.assertEqual(len(storage.saved), 2)
+
+    def test_unchanged_files_skipped(self):
+        storage = self.storage(True, files=['a.css', 'b.js'])
+        command = self.command(storage)
+        self.copy_all(command)
+        self.assertEqual(storage.is_unchanged.call_count, 2)
+        self.assertEqual(storage.saved, [('b.js', b'b.js')])
+        self.assertEqual(storage.files['a.css'], b'')
+        self.assertEqual(command.unmodified_files, ['a.css'])
+        self.assertEqual(command.copied_files, ['b.js'])
+
+
+class TestBatches(CommandTestCase):
+
+    def test_batches(self):
+        storage = BatchStorage()
+        command = self.command(storage, '--max-workers', '3')
+        self.assertTrue(command._batching)
+        with mock.patch.object(storage, 'save_many', wraps=storage.save_many) as save_many:
+            self.copy_all(command)
+        self.assertEqual(save_many.call_args[1], {'max_workers': 3})
+        self.assertEqual(storage.batches, [[('a.css', b'a.css'), ('b.js', b'b.js')]])
+        self.assertEqual(storage.saved, [])
+        self.assertEqual(command.copied_files, ['a.css', 'b.js'])
+
+    def test_collect(self):
+        storage = BatchStorage()
+        command = self.command(storage)
+        with override_settings(STATICFILES_DIRS=[self.source_dir]):
+            collected = command.collect()
+        self.assertEqual(sorted(collected['modified']), ['a.css', 'b.js'])
+        self.assertEqual(sorted(storage.batches[0]), [('a.css', b'a.css'), ('b.js', b'b.js')])
+        storage.shutdown.assert_called_once_with()
+
+    def test_dry_run_uses_stock_path(self):
+        storage = BatchStorage()
+        command = self.command(storage, '--dry-run')
+        self.assertFalse(command._batching)
+        self.copy_all(command)
+        self.assertEqual(storage.batches, [])
+        self.assertEqual(storage.saved, [])
+        self.assertEqual(command.copied_files, ['a.css', 'b.js'])
+
+    def test_post_processing_storage_uses_stock_path(self):
+        storage = PostProcessingStorage()
+        command = self.command(storage)
+        self.assertFalse(command._batching)
+        self.copy_all(command)
+        self.assertEqual(storage.batches, [])
+        self.assertEqual(storage.saved, [('a.css', b'a.css'), ('b.js', b'b.js')])
+
+    def test_post_processing_disabled_batches(self):
+        command = self.command(PostProcessingStorage(), '--no-post-process')
+        self.assertTrue(command._batching)
+
+    def test_storage_without_save_many(self):
+        storage = RecordingStorage()
+        command = self.command(storage)
+        self.assertFalse(command._batching)
+        self.copy_all(command)
+        self.assertEqual(storage.saved, [('a.css', b'a.css'), ('b.js', b'b.js')])
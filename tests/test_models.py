@@ -1,25 +0,0 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
-
-"""
-test_django_ssh_storage
-------------
-
-Tests for `django_ssh_storage` models module.
-"""
-
-from django.test import TestCase
-
-from ssh_storage import models
-
-
-class TestSsh_storage(TestCase):
-
-    def setUp(self):
-        pass
-
-    def test_something(self):
-        pass
-
-    def tearDown(self):
-        pass
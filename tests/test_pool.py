@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pool
+------------
+
+Tests for the `ssh_storage.pool` module.
+"""
+
+import threading
+
+import mock
+
+from django.test import SimpleTestCase
+
+from ssh_storage import pool
+
+
+CONFIG = {
+    'hostname': 'ssh.example.com',
+    'username': 'storage',
+    'port': 22,
+    'rsa_key': None,
+    'password': 'secret',
+    'buffer_size': 1024,
+}
+
+
+def fake_manager(*args, **kwargs):
+    manager = mock.Mock()
+    manager.setup.return_value = True
+    manager.is_active.return_value = True
+    manager.claim.return_value = True
+    return manager
+
+
+class TestPool(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(pool, 'SSHClientManager', side_effect=fake_manager)
+        self.factory = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        pool.clear()
+        pool._assigned().clear()
+
+    def test_acquire_reuses_connection(self):
+        manager = pool.acquire(CONFIG)
+        self.assertIs(pool.acquire(CONFIG), manager)
+        self.assertEqual(self.factory.call_count, 1)
+        manager.setup.assert_called_once_with()
+
+    def test_acquire_per_config(self):
+        other = dict(CONFIG, hostname='other.example.com')
+        self.assertIsNot(pool.acquire(CONFIG), pool.acquire(other))
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_acquire_shared_between_threads(self):
+        manager = pool.acquire(CONFIG)
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire(CONFIG)))
+        thread.start()
+        thread.join()
+        self.assertEqual(acquired, [manager])
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_acquire_opens_another_connection_when_full(self):
+        manager = pool.acquire(CONFIG)
+        manager.claim.return_value = False
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire(CONFIG)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(acquired[0], manager)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_acquire_recycles_dead_connection(self):
+        dead = pool.acquire(CONFIG)
+        dead.is_active.return_value = False
+        manager = pool.acquire(CONFIG)
+        self.assertIsNot(manager, dead)
+        dead.close_connection.assert_called_once_with()
+        self.assertEqual(pool._shared[pool._key(CONFIG)], [manager])
+
+    def test_acquire_failed_login(self):
+        self.factory.side_effect = None
+        self.factory.return_value.setup.return_value = False
+        self.assertIsNone(pool.acquire(CONFIG))
+        self.assertEqual(pool._shared[pool._key(CONFIG)], [])
+
+    def test_release(self):
+        manager = pool.acquire(CONFIG)
+        pool.release(CONFIG)
+        manager.close_sftp.assert_called_once_with()
+        manager.claim.reset_mock()
+        # The connection stays in the pool, the session is claimed again
+        self.assertIs(pool.acquire(CONFIG), manager)
+        manager.claim.assert_called_once_with()
+
+    def test_clear(self):
+        manager = pool.acquire(CONFIG)
+        pool.clear()
+        manager.close_connection.assert_called_once_with()
+        self.assertEqual(dict(pool._shared), {})
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sshclientmanager
+------------
+
+Tests for the `ssh_storage.sshclientmanager` module.
+"""
+
+import errno
+import os
+import tempfile
+import threading
+import time
+
+import mock
+import paramiko
+
+from django.test import SimpleTestCase
+from six import BytesIO
+
+from ssh_storage import sshclientmanager
+from ssh_storage.sshclientmanager import SSHClientManager
+
+
+class RemoteFile(BytesIO):
+    """In-memory stand-in for a paramiko SFTPFile opened for writing."""
+
+    pipelined = False
+    contents = None
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+    def close(self):
+        if not self.closed:
+            self.contents = self.getvalue()
+        BytesIO.close(self)
+
+
+class ManagerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.manager = SSHClientManager('ssh.example.com', basepath='')
+        self.sftp = mock.Mock()
+        self.remote = RemoteFile()
+        self.sftp.open.return_value = self.remote
+        # What the sftp property returns for the current thread
+        self.manager._local.sftp = self.sftp
+
+
+class TestUpload(ManagerTestCase):
+
+    def test_pipelined_write(self):
+        self.assertTrue(self.manager.upload(BytesIO(b'data'), path='/srv/storage/dir', destname='a.txt'))
+        self.sftp.open.assert_called_once_with('/srv/storage/dir/a.txt', 'wb')
+        self.assertTrue(self.remote.pipelined)
+        self.assertEqual(self.remote.contents, b'data')
+
+    def test_error(self):
+        self.sftp.open.side_effect = IOError(errno.EACCES, 'Permission denied')
+        self.assertFalse(self.manager.upload(BytesIO(b'data'), path='/srv/storage/dir', destname='a.txt'))
+
+    def test_recreates_removed_directory(self):
+        self.manager.mkdir('/srv/storage/dir')
+        self.sftp.open.side_effect = [IOError(errno.ENOENT, 'No such file'), self.remote]
+        self.assertTrue(self.manager.upload(BytesIO(b'data'), path='/srv/storage/dir', destname='a.txt'))
+        self.assertEqual(self.sftp.mkdir.call_count, 2)
+        self.assertEqual(self.remote.contents, b'data')
+
+
+class TestFreeName(ManagerTestCase):
+
+    def test_overwrite(self):
+        self.manager.upload(BytesIO(b'data'), path='/srv/storage', destname='a.txt')
+        self.sftp.listdir.assert_not_called()
+        self.sftp.open.assert_called_once_with('/srv/storage/a.txt', 'wb')
+
+    def test_taken_names(self):
+        self.sftp.listdir.return_value = ['a.txt', 'a_1.txt', 'b.txt']
+        self.manager.upload(BytesIO(b'data'), path='/srv/storage', destname='a.txt', overwrite=False)
+        self.sftp.listdir.assert_called_once_with('/srv/storage')
+        self.sftp.lstat.assert_not_called()
+        self.sftp.open.assert_called_once_with('/srv/storage/a_2.txt', 'wb')
+
+    def test_free_name(self):
+        self.sftp.listdir.return_value = ['b.txt']
+        self.assertEqual(self.manager._free_name('/srv/storage', 'a.txt'), 'a.txt')
+
+    def test_unreadable_directory(self):
+        self.sftp.listdir.side_effect = IOError()
+        self.assertEqual(self.manager._free_name('/srv/storage', 'a.txt'), 'a.txt')
+
+
+class TestWrite(ManagerTestCase):
+
+    def test_file_object(self):
+        source = BytesIO(b'data')
+        with mock.patch('ssh_storage.sshclientmanager.open', create=True) as local_open:
+            self.manager._write(source, '/srv/storage/a.txt')
+        local_open.assert_not_called()
+        self.assertEqual(self.remote.contents, b'data')
+
+    def test_local_path(self):
+        handle, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'wb') as localfile:
+            localfile.write(b'data')
+        self.manager._write(path, '/srv/storage/a.txt')
+        self.sftp.open.assert_called_once_with('/srv/storage/a.txt', 'wb')
+        self.assertEqual(self.remote.contents, b'data')
+
+    def test_buffer_size(self):
+        self.manager.buffer_size = 1234
+        source = BytesIO(b'data')
+        with mock.patch('ssh_storage.sshclientmanager.shutil.copyfileobj') as copyfileobj:
+            self.manager._write(source, '/srv/storage/a.txt')
+        copyfileobj.assert_called_once_with(source, self.remote, 1234)
+
+
+class TestMkdir(ManagerTestCase):
+
+    def setUp(self):
+        super(TestMkdir, self).setUp()
+        self.stdout = mock.Mock()
+        self.manager.execute_command = mock.Mock(return_value=(None, self.stdout, None))
+
+    def test_cached(self):
+        self.manager.mkdir('/srv/storage/dir')
+        self.manager.mkdir('/srv/storage/dir')
+        self.sftp.mkdir.assert_called_once_with('/srv/storage/dir')
+
+    def test_mkdir_p(self):
+        self.sftp.mkdir.side_effect = IOError()
+        self.stdout.channel.recv_exit_status.return_value = 0
+        self.manager.mkdir('/srv/storage/new dir')
+        self.manager.execute_command.assert_called_once_with("mkdir -p -- '/srv/storage/new dir'")
+        self.sftp.lstat.assert_not_called()
+
+    def test_walk_without_commands(self):
+        self.stdout.channel.recv_exit_status.return_value = 1
+        self.sftp.mkdir.side_effect = [IOError(), None]
+        self.sftp.lstat.side_effect = [None, IOError()]
+        self.manager.mkdir('/srv/new')
+        self.assertEqual(self.sftp.lstat.call_args_list, [mock.call('/srv'), mock.call('/srv/new')])
+        self.assertEqual(self.sftp.mkdir.call_args_list, [mock.call('/srv/new'), mock.call('/srv/new')])
+        self.manager.mkdir('/srv/new')
+        self.assertEqual(self.sftp.mkdir.call_count, 2)
+
+
+class TestChecksum(ManagerTestCase):
+
+    def setUp(self):
+        super(TestChecksum, self).setUp()
+        self.stdout = mock.Mock()
+        self.stdout.read.return_value = b'A' * 64 + b'  /srv/storage/a b.txt\n'
+        self.stdout.channel.recv_exit_status.return_value = 0
+        self.manager.execute_command = mock.Mock(return_value=(None, self.stdout, None))
+
+    def test_sha256sum_output(self):
+        self.assertEqual(self.manager.checksum('/srv/storage/a b.txt'), 'a' * 64)
+        self.manager.execute_command.assert_called_once_with("sha256sum -- '/srv/storage/a b.txt'")
+
+    def test_failed_command(self):
+        self.stdout.read.return_value = b''
+        self.stdout.channel.recv_exit_status.return_value = 1
+        self.assertIsNone(self.manager.checksum('/srv/storage/a.txt'))
+
+    def test_commands_not_allowed(self):
+        self.manager.execute_command.side_effect = paramiko.SSHException()
+        self.assertIsNone(self.manager.checksum('/srv/storage/a.txt'))
+
+
+class TestSessions(SimpleTestCase):
+
+    def setUp(self):
+        self.manager = SSHClientManager('ssh.example.com', basepath='')
+        self.manager._ssh = mock.Mock()
+        patcher = mock.patch.object(
+            paramiko.SFTPClient, 'from_transport', side_effect=lambda *args, **kwargs: mock.Mock()
+        )
+        self.from_transport = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_session_per_thread(self):
+        sftp = self.manager.sftp
+        self.assertIs(self.manager.sftp, sftp)
+        self.from_transport.assert_called_once_with(
+            self.manager._ssh.get_transport(), window_size=sshclientmanager.WINDOW_SIZE
+        )
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.manager.sftp))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], sftp)
+
+        # The session of the thread that is gone is closed with the next one
+        self.manager.close_sftp()
+        sftp.close.assert_called_once_with()
+        self.manager.sftp
+        other[0].close.assert_called_once_with()
+
+    def test_sessions_per_connection(self):
+        done = threading.Event()
+        claimed = []
+
+        def claim():
+            claimed.append(self.manager.claim())
+            done.wait()
+
+        threads = [threading.Thread(target=claim)
+                   for _ in range(sshclientmanager.SESSIONS_PER_CONNECTION + 1)]
+        for thread in threads:
+            thread.start()
+        while len(claimed) < len(threads):
+            time.sleep(0.01)
+        self.assertEqual(claimed.count(True), sshclientmanager.SESSIONS_PER_CONNECTION)
+        self.assertEqual(claimed.count(False), 1)
+
+        # Threads that are gone leave their slot
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(self.manager.claim())
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_storage
+------------
+
+Tests for the `ssh_storage.storage` module.
+"""
+
+import hashlib
+import stat
+import threading
+import time
+
+import mock
+import paramiko
+
+from django.core.cache import caches
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, override_settings
+
+from ssh_storage import storage
+from ssh_storage.custom_storage import StaticStorage
+from ssh_storage.storage import PREFETCH_SIZE, SSHStorage, SSHStorageException, StatCache
+
+
+LOCATION = {
+    'HOSTNAME': 'ssh.example.com',
+    'USERNAME': 'storage',
+    'PASSWORD': 'secret',
+    'BASEPATH': '/srv/storage',
+}
+
+
+def sftp_attributes(filename, mode, size=0):
+    attr = paramiko.SFTPAttributes()
+    attr.filename = filename
+    attr.st_mode = mode
+    attr.st_size = size
+    return attr
+
+
+class PrefetchedFile(object):
+    """Stand-in for a paramiko SFTPFile opened for reading."""
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+        self.prefetched = []
+
+    def prefetch(self, file_size=None):
+        self.prefetched.append((self.position, file_size))
+
+    def tell(self):
+        return self.position
+
+    def read(self, size):
+        size = min(size, self.size - self.position)
+        self.position += size
+        return b'x' * size
+
+
+class StorageTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.manager = mock.Mock()
+        self.manager.upload.return_value = True
+        self.sftp = self.manager.sftp
+        patcher = mock.patch('ssh_storage.storage.pool.acquire', return_value=self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = SSHStorage(LOCATION)
+
+
+class TestConfig(SimpleTestCase):
+
+    def setUp(self):
+        storage._decoded_locations.clear()
+        self.addCleanup(storage._decoded_locations.clear)
+        patcher = mock.patch.object(
+            SSHStorage, '_decode_location', autospec=True, side_effect=SSHStorage._decode_location
+        )
+        self.decode = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_decoded_once(self):
+        first = SSHStorage(LOCATION)
+        second = SSHStorage(dict(LOCATION))
+        self.assertEqual(self.decode.call_count, 1)
+        self.assertEqual(first._config, second._config)
+        # Each storage can change its own copy
+        self.assertIsNot(first._config, second._config)
+
+    def test_unhashable_location(self):
+        location = dict(LOCATION, EXTRA=['unhashable'])
+        SSHStorage(location)
+        SSHStorage(location)
+        self.assertEqual(self.decode.call_count, 2)
+        self.assertEqual(storage._decoded_locations, {})
+
+
+class TestPaths(SimpleTestCase):
+
+    def test_plain_storage(self):
+        plain = SSHStorage(LOCATION)
+        self.assertEqual(plain._remote_path('dir/a.txt'), '/srv/storage/dir/a.txt')
+        self.assertEqual(plain.url('dir/a.txt'), 'http://ssh.example.com/dir/a.txt')
+
+    def test_trailing_slash_in_basepath(self):
+        plain = SSHStorage(dict(LOCATION, BASEPATH='/srv/storage/'))
+        self.assertEqual(plain._remote_path('a.txt'), '/srv/storage/a.txt')
+
+    def test_static_proxy(self):
+        proxied = SSHStorage(dict(
+            LOCATION,
+            STATIC_PROXY_PROTOCOL='https://',
+            STATIC_PROXY_HOSTNAME='static.example.com',
+            STATIC_PROXY_PORT='8080',
+        ))
+        self.assertEqual(proxied.url('a.txt'), 'https://static.example.com:8080/a.txt')
+        self.assertEqual(proxied._remote_path('a.txt'), '/srv/storage/a.txt')
+
+    @override_settings(STATICFILES_LOCATION='static')
+    def test_location(self):
+        static = StaticStorage(LOCATION)
+        self.assertEqual(static._remote_path('css/a.css'), '/srv/storage/static/css/a.css')
+        self.assertEqual(static.url('css/a.css'), 'http://ssh.example.com/static/css/a.css')
+        # The decoded settings shared with other storages are left alone
+        self.assertEqual(SSHStorage(LOCATION)._remote_path('a.txt'), '/srv/storage/a.txt')
+
+    @override_settings(STATICFILES_LOCATION='static')
+    def test_leading_slash(self):
+        for storage_class in (SSHStorage, StaticStorage):
+            named = storage_class(LOCATION)
+            self.assertEqual(named.url('/css/a.css'), named.url('css/a.css'))
+            self.assertEqual(named._remote_path('/css/a.css'), named._remote_path('css/a.css'))
+        self.assertEqual(StaticStorage(LOCATION).url('//css/a.css'), 'http://ssh.example.com/static/css/a.css')
+
+
+class TestStatCache(SimpleTestCase):
+
+    def test_get_missing(self):
+        with self.assertRaises(KeyError):
+            StatCache().get('/srv/storage/a.txt')
+
+    def test_expiry(self):
+        cache = StatCache(timeout=-1)
+        cache.set('/srv/storage/a.txt', 'attr')
+        with self.assertRaises(KeyError):
+            cache.get('/srv/storage/a.txt')
+
+    def test_least_recently_used_evicted(self):
+        cache = StatCache(size=2)
+        cache.set('/a', 1)
+        cache.set('/b', 2)
+        cache.get('/a')
+        cache.set('/c', 3)
+        self.assertEqual(cache.get('/a'), 1)
+        self.assertEqual(cache.get('/c'), 3)
+        with self.assertRaises(KeyError):
+            cache.get('/b')
+
+
+class TestStatCacheInvalidation(StorageTestCase):
+
+    def setUp(self):
+        super(TestStatCacheInvalidation, self).setUp()
+        self.sftp.stat.return_value = sftp_attributes('a.txt', stat.S_IFREG, size=3)
+
+    def test_stat_cached(self):
+        self.assertTrue(self.storage.exists('a.txt'))
+        self.assertEqual(self.storage.size('a.txt'), 3)
+        self.sftp.stat.assert_called_once_with('/srv/storage/a.txt')
+
+    def test_save_forgets_stat(self):
+        self.storage.exists('a.txt')
+        self.storage._save('a.txt', ContentFile(b'abcd'))
+        self.sftp.stat.return_value = sftp_attributes('a.txt', stat.S_IFREG, size=4)
+        self.assertEqual(self.storage.size('a.txt'), 4)
+        self.assertEqual(self.sftp.stat.call_count, 2)
+
+    def test_delete_forgets_stat(self):
+        self.storage.exists('a.txt')
+        self.storage.delete('a.txt')
+        self.sftp.remove.assert_called_once_with('/srv/storage/a.txt')
+        self.sftp.stat.side_effect = IOError()
+        self.assertFalse(self.storage.exists('a.txt'))
+
+    def test_listdir_seeds_stat(self):
+        self.sftp.listdir_attr.return_value = [
+            sftp_attributes('a.txt', stat.S_IFREG, size=5),
+            sftp_attributes('sub', stat.S_IFDIR),
+        ]
+        self.assertEqual(self.storage.listdir('dir'), (['sub'], ['a.txt']))
+        self.sftp.listdir_attr.assert_called_once_with('/srv/storage/dir')
+        self.assertEqual(self.storage.size('dir/a.txt'), 5)
+        self.assertTrue(self.storage.exists('dir/sub'))
+        self.sftp.stat.assert_not_called()
+
+    def test_listdir_forgets_removed_entries(self):
+        self.storage.exists('a.txt')
+        self.storage.exists('sub/b.txt')
+        self.sftp.listdir_attr.return_value = []
+        self.storage.listdir('')
+        self.sftp.stat.side_effect = IOError()
+        self.assertFalse(self.storage.exists('a.txt'))
+        # Entries of subdirectories aren't part of the listing
+        self.assertTrue(self.storage.exists('sub/b.txt'))
+
+    def test_listdir_skips_symlinks(self):
+        self.sftp.listdir_attr.return_value = [sftp_attributes('link', stat.S_IFLNK)]
+        self.storage.listdir('')
+        self.storage.exists('link')
+        self.sftp.stat.assert_called_once_with('/srv/storage/link')
+
+
+class TestRead(StorageTestCase):
+
+    def open(self, size):
+        self.sftp.stat.return_value = sftp_attributes('a.bin', stat.S_IFREG, size=size)
+        self.remote = PrefetchedFile(size)
+        self.sftp.open.return_value = self.remote
+        return self.storage.open('a.bin')
+
+    def test_short_read_prefetches_a_window(self):
+        content = self.open(10 * PREFETCH_SIZE)
+        self.assertEqual(len(content.read(100)), 100)
+        self.assertEqual(self.remote.prefetched, [(0, PREFETCH_SIZE)])
+        self.sftp.open.assert_called_once_with('/srv/storage/a.bin', 'rb')
+
+    def test_next_window_once_read(self):
+        content = self.open(10 * PREFETCH_SIZE)
+        content.read(PREFETCH_SIZE - 100)
+        content.read(200)
+        self.assertEqual(self.remote.prefetched, [(0, PREFETCH_SIZE), (PREFETCH_SIZE, 2 * PREFETCH_SIZE)])
+
+    def test_read_all(self):
+        content = self.open(1000)
+        self.assertEqual(len(content.read()), 1000)
+        self.assertEqual(content.read(10), b'')
+        self.assertEqual(self.remote.prefetched, [(0, 1000)])
+
+
+class TestWrite(StorageTestCase):
+
+    def test_close_streams_written_content(self):
+        uploaded = []
+
+        def upload(sourcefile, destname, path):
+            uploaded.append((path, destname, sourcefile.read()))
+            return True
+        self.manager.upload.side_effect = upload
+
+        content = self.storage.open('dir/a.txt', 'wb')
+        content.write(b'data')
+        content.close()
+        self.assertEqual(uploaded, [('/srv/storage/dir', 'a.txt', b'data')])
+
+    def test_read_only(self):
+        content = self.storage.open('a.txt')
+        with self.assertRaises(AttributeError):
+            content.write(b'data')
+
+
+class TestSaveMany(StorageTestCase):
+
+    def tearDown(self):
+        self.storage.shutdown()
+
+    def test_empty(self):
+        self.assertEqual(self.storage.save_many([]), [])
+
+    def test_order(self):
+        # Later files finish first
+        def upload(sourcefile, destname, path):
+            time.sleep(0.01 * (10 - int(destname.split('.')[0])))
+            return True
+        self.manager.upload.side_effect = upload
+
+        names = ['{}.txt'.format(i) for i in range(10)]
+        saved = self.storage.save_many(
+            [(name, ContentFile(b'data')) for name in names], max_workers=4
+        )
+        self.assertEqual(saved, names)
+        self.assertEqual(self.manager.upload.call_count, 10)
+
+    def test_accepts_file_objects(self):
+        saved = self.storage.save_many([('a.txt', ContentFile(b'data').file)])
+        self.assertEqual(saved, ['a.txt'])
+
+    def test_error_raised_after_all_uploads(self):
+        lock = threading.Lock()
+        uploaded = []
+
+        def upload(sourcefile, destname, path):
+            with lock:
+                uploaded.append(destname)
+            return destname != '3.txt'
+        self.manager.upload.side_effect = upload
+
+        names = ['{}.txt'.format(i) for i in range(10)]
+        with self.assertRaises(SSHStorageException):
+            self.storage.save_many([(name, ContentFile(b'data')) for name in names], max_workers=4)
+        self.assertEqual(sorted(uploaded), sorted(names))
+
+    def test_names_validated(self):
+        for name in ('../../etc/passwd', 'dir/../../x', '/etc/passwd', 'dir/', '..'):
+            with self.assertRaises(SuspiciousFileOperation):
+                self.storage.save_many([('a.txt', ContentFile(b'data')), (name, ContentFile(b'data'))])
+        self.manager.upload.assert_not_called()
+        self.assertEqual(self.storage.save_many([('dir/a..b.txt', ContentFile(b'data'))]), ['dir/a..b.txt'])
+
+    def test_executor_reused_until_shutdown(self):
+        self.storage.save_many([('a.txt', ContentFile(b'data'))], max_workers=2)
+        executor = self.storage._executor
+        self.storage.save_many([('b.txt', ContentFile(b'data'))], max_workers=2)
+        self.assertIs(self.storage._executor, executor)
+        self.storage.shutdown()
+        self.assertIsNone(self.storage._executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(len, '')
+
+
+class TestChecksumSkip(StorageTestCase):
+
+    def setUp(self):
+        super(TestChecksumSkip, self).setUp()
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        self.storage = SSHStorage(dict(LOCATION, CHECKSUM_SKIP=True))
+        self.manager.checksum.return_value = hashlib.sha256(b'data').hexdigest()
+
+    def test_disabled_by_default(self):
+        storage = SSHStorage(LOCATION)
+        self.assertFalse(storage.checksum_skip)
+        self.assertFalse(storage.is_unchanged('a.txt', ContentFile(b'data')))
+        self.manager.checksum.assert_not_called()
+
+    def test_string_false(self):
+        self.assertFalse(SSHStorage(dict(LOCATION, CHECKSUM_SKIP='False')).checksum_skip)
+        self.assertTrue(SSHStorage(dict(LOCATION, CHECKSUM_SKIP='true')).checksum_skip)
+
+    def test_same_checksum(self):
+        content = ContentFile(b'data')
+        self.assertTrue(self.storage.is_unchanged('a.txt', content))
+        self.manager.checksum.assert_called_once_with('/srv/storage/a.txt')
+        # The content can still be read from the start
+        self.assertEqual(content.read(), b'data')
+
+    def test_different_checksum(self):
+        self.assertFalse(self.storage.is_unchanged('a.txt', ContentFile(b'other')))
+
+    def test_missing_remote_file(self):
+        self.manager.checksum.return_value = None
+        self.assertFalse(self.storage.is_unchanged('a.txt', ContentFile(b'data')))
+
+    def test_remote_checksum_cached(self):
+        self.storage.is_unchanged('a.txt', ContentFile(b'data'))
+        self.assertTrue(self.storage.is_unchanged('a.txt', ContentFile(b'data')))
+        self.assertEqual(self.manager.checksum.call_count, 1)
+
+    def test_save_records_checksum(self):
+        self.storage._save('a.txt', ContentFile(b'new'))
+        self.assertTrue(self.storage.is_unchanged('a.txt', ContentFile(b'new')))
+        self.manager.checksum.assert_not_called()
+
+    def test_delete_drops_checksum(self):
+        self.storage._save('a.txt', ContentFile(b'new'))
+        self.storage.delete('a.txt')
+        self.assertFalse(self.storage.is_unchanged('a.txt', ContentFile(b'new')))
+        self.manager.checksum.assert_called_once_with('/srv/storage/a.txt')